@@ -3,23 +3,36 @@ import asyncio
 import importlib
 import importlib.util
 import inspect
-import io
 import json
 import logging
+import mmap
 import os
 import re
-import subprocess
 import sys
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Optional
+from operator import itemgetter
+from types import ModuleType
+from typing import Dict, List, Optional, Set, Tuple
 
 import psutil
 from pypresence import AioPresence
 
 __version__ = "1.0.0-dev8"
-logging.basicConfig(format="[%(levelname)s]: %(message)s", level=logging.DEBUG)
+logging.basicConfig(format="[%(levelname)s]: %(message)s", level=logging.INFO)
+logger = logging.getLogger("winerpc")
+
+_WINE_VER_RE = re.compile(r"^Wine\s\d+\.\d+")
+_PRINTABLE = frozenset(range(0x20, 0x7F)) | {0x09}
+_PRELOADERS = frozenset({"wine-preloader", "wine64-preloader"})
+_LOADERS = _PRELOADERS | {"wine", "wine64"}
+# wrappers that commonly exec into wine, a wrapper missing here that execs
+# within the first tick of its lifetime keeps its own name for that pid
+_LAUNCHERS = frozenset(
+    {"sh", "bash", "dash", "zsh", "env", "nice", "taskset", "gamemoderun"}
+)
+_PLUGIN_CACHE: Dict[Tuple[str, float], ModuleType] = {}
 
 
 @dataclass
@@ -42,19 +55,52 @@ class State:
     process: Optional[App] = None
     mode: StateMode = StateMode.INACTIVE
     server: Optional[str] = None
+    server_pid: Optional[int] = None
+    _server_cache: Dict[str, Optional[str]] = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
 
     def get_server_version(self) -> Optional[str]:
         """get running wine server version"""
-        if not self.server:
+        server = self.server
+
+        if not server:
             return
 
-        for string in io.StringIO(
-            subprocess.check_output(["strings", self.server]).decode()
-        ).readlines():
-            version = re.match(r"^Wine\s\d+\.\d+", string)
+        if server in self._server_cache:
+            return self._server_cache[server]
+
+        version = None
+
+        with open(server, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            index = data.find(b"Wine")
+
+            while index != -1:
+                # same boundaries `strings` would use: a run of printable bytes
+                if index == 0 or data[index - 1] not in _PRINTABLE:
+                    end = index
+                    while end < len(data) and data[end] in _PRINTABLE:
+                        end += 1
+
+                    match = _WINE_VER_RE.match(data[index:end].decode("ascii"))
+
+                    if match:
+                        version = match.string.strip()
+                        break
 
-            if version:
-                return version.string.strip()
+                index = data.find(b"Wine", index + 4)
+
+        self._server_cache[server] = version
+        return version
+
+    def clear_server(self):
+        """forget the running wine server and its cached version"""
+        if self.server:
+            self._server_cache.pop(self.server, None)
+        self.server = None
+        self.server_pid = None
 
 
 class AppDB:
@@ -67,16 +113,11 @@ class AppDB:
             self.apps.append(
                 App([exe.lower() for exe in app["exe"]], app["title"], app.get("icon"))
             )
-        logging.info(f"Loaded {len(self.apps)} apps from database.")
-
-    @staticmethod
-    def _get(exe: str, apps: List[App]) -> Optional[App]:
-        for app in apps:
-            if exe in [e.lower() for e in app.exe]:
-                return app
+        self._index: Dict[str, App] = {e: app for app in self.apps for e in app.exe}
+        logger.info("Loaded %d apps from database.", len(self.apps))
 
     def get(self, exe: str) -> Optional[App]:
-        return self._get(exe, self.apps)
+        return self._index.get(exe)
 
 
 class WineRPC:
@@ -85,28 +126,50 @@ class WineRPC:
         self.loop = asyncio.new_event_loop()
         self.rpc.loop = self.loop
         self.config = config
+        self._set_log_level(config.get("log_level", "INFO"))
         self.lock = asyncio.Lock()
+        self.process_event = asyncio.Event()
+        self._rpc_queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._poll_active = config.get("poll_interval", 5)
+        self._poll_idle = config.get("idle_poll_interval", 15)
 
         self.state = State()
+        self._pid_cache: Dict[int, Tuple[float, Optional[str]]] = {}
+        self._scan_buf: List[Tuple[float, psutil.Process, App]] = []
+        self._scan_pids: Set[int] = set()
         self.apps = AppDB(self.config["app_list_path"])
 
+    @staticmethod
+    def _set_log_level(level: str | int):
+        if isinstance(level, str):
+            level = level.upper()
+
+        try:
+            logger.setLevel(level)
+        except (TypeError, ValueError):
+            logger.setLevel(logging.INFO)
+            logger.warning("Unknown log level: %s, using INFO.", level)
+
     @staticmethod
     def load_plugin(name: str):
-        if os.path.isfile(os.path.join("plugins", f"{name}.py")):
-            spec = importlib.util.spec_from_file_location(
-                name, os.path.join("plugins", f"{name}.py")
-            )
-            mod = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(mod)
+        path = os.path.join("plugins", f"{name}.py")
+
+        if os.path.isfile(path):
+            key = (name, os.stat(path).st_mtime)
+            mod = _PLUGIN_CACHE.get(key)
+
+            if mod is None:
+                spec = importlib.util.spec_from_file_location(name, path)
+                mod = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(mod)
+                _PLUGIN_CACHE[key] = mod
 
             if hasattr(mod, "_plugin_entry"):
                 if inspect.iscoroutinefunction(getattr(mod, "_plugin_entry")):
                     return mod
 
-    async def _update(self, app: App, state: Optional[str] = None):
-        self.state.process = app
-
-        await self.rpc.update(
+    def _presence(self, app: App, state: Optional[str] = None) -> dict:
+        return dict(
             details=f"Playing {app.title}",
             start=app.start_time if app.start_time else time.time(),
             small_image="https://static.wikia.nocookie.net/logopedia/images/8/87/Wine_2008.png",
@@ -116,6 +179,47 @@ class WineRPC:
             large_text=app.title,
         )
 
+    def _set_process(self, app: Optional[App]):
+        self.state.process = app
+
+        if app:
+            self.process_event.set()
+        else:
+            self.process_event.clear()
+
+    async def _update(self, app: App, state: Optional[str] = None):
+        self._set_process(app)
+
+        await self.rpc.update(**self._presence(app, state))
+
+    def _publish(self, presence: Optional[dict]):
+        """queue a presence for the writer task, `None` clears it"""
+        while not self._rpc_queue.empty():
+            self._rpc_queue.get_nowait()
+
+        self._rpc_queue.put_nowait(presence)
+
+    async def _rpc_writer(self):
+        while True:
+            presence = await self._rpc_queue.get()
+
+            try:
+                async with self.lock:
+                    if presence is None:
+                        await self.rpc.clear()
+                    else:
+                        await self.rpc.update(**presence)
+            except Exception:
+                logger.exception("Couldn't update Discord RPC presence.")
+
+    @property
+    def poll_interval(self) -> float:
+        """seconds to wait between scans, longer while no wine app is running"""
+        if self.state.mode is StateMode.INACTIVE:
+            return self._poll_idle
+
+        return self._poll_active
+
     def process_iter(self, reverse: bool = True):
         """Iterates process from new to old"""
         return sorted(
@@ -123,110 +227,189 @@ class WineRPC:
         )
 
     def get_process_basename(self, process: psutil.Process) -> str:
-        proc = os.path.basename(process.exe().replace("\\", os.sep))
+        return self._resolve_basename(process)[0]
 
-        if proc in ("wine-preloader", "wine64-preloader") and process.cmdline():
-            proc = os.path.basename(process.cmdline()[0].replace("\\", os.sep))
+    def _resolve_basename(self, process: psutil.Process) -> Tuple[str, bool]:
+        """get the process basename and whether it stays valid for the pid"""
+        exe = process.exe()
+        if "\\" in exe:
+            exe = exe.replace("\\", os.sep)
+        proc = os.path.basename(exe)
 
-        return proc
+        if proc in _PRELOADERS:
+            cmdline = process.cmdline()
 
-    async def _scan(self):
-        while self.state.mode in [StateMode.SCANNING, StateMode.RUNNING]:
-            apps: List[App] = []
+            if cmdline:
+                proc = os.path.basename(cmdline[0].replace("\\", os.sep))
 
-            for proc in self.process_iter():
-                try:
-                    exe = self.get_process_basename(proc).lower()
-                    app = self.apps.get(exe)
-
-                    if app and not self.apps._get(exe, apps):
-                        app.pid = proc.pid
-                        app.start_time = proc.create_time()
-                        apps.append(app)
-                except (psutil.AccessDenied, psutil.NoSuchProcess):
+            # wine rewrites the preloader's argv once the app is loaded
+            return proc, False
+
+        # wine and launchers exec into something else without changing pid or
+        # create_time, so their name is only valid until the next tick
+        return proc, proc not in _LOADERS and proc not in _LAUNCHERS
+
+    def find_wineserver(self) -> Optional[Tuple[int, str]]:
+        """get the pid and executable path of a running wineserver"""
+        if sys.platform == "linux":
+            servers: List[Tuple[float, int, str]] = []
+
+            for pid in os.listdir("/proc"):
+                if not pid.isdigit():
                     continue
 
-            if apps:
-                if self.state.mode is not StateMode.RUNNING:
-                    self.state.mode = StateMode.RUNNING
-                    logging.info("New process is running: " + apps[0].title)
+                try:
+                    with open(f"/proc/{pid}/comm", "r") as file:
+                        if file.read().strip() != "wineserver":
+                            continue
 
-                    async with self.lock:
-                        await self._update(apps[0])
-                elif self.state.process is not apps[0]:
-                    logging.info("Process updated to: " + apps[0].title)
+                    proc = psutil.Process(int(pid))
+                    exe = proc.exe()
 
-                    async with self.lock:
-                        await self.rpc.clear()
-                        await self._update(apps[0])
-            elif self.state.mode is StateMode.RUNNING:
-                logging.info("Process stopped: " + self.state.process.title)
-                self.state.process = None
-                self.state.server = None
-                self.state.mode = StateMode.INACTIVE
+                    if os.path.basename(exe) == "wineserver":
+                        servers.append((proc.create_time(), proc.pid, exe))
+                except (OSError, psutil.AccessDenied, psutil.NoSuchProcess):
+                    continue
 
-                async with self.lock:
-                    await self.rpc.clear()
+            if servers:
+                return max(servers, key=itemgetter(0))[1:]
+
+            return
+
+        for proc in self.process_iter():
+            try:
+                with proc.oneshot():
+                    if self.get_process_basename(proc) == "wineserver":
+                        return proc.pid, proc.exe()
+            except (psutil.AccessDenied, psutil.NoSuchProcess):
+                continue
+
+    def _scan_once(self):
+        """look for running apps once and update the presence"""
+        matches = self._scan_buf
+        pids = self._scan_pids
+        matches.clear()
+        pids.clear()
+
+        for proc in psutil.process_iter():
+            try:
+                create_time = proc.create_time()
+                cached = self._pid_cache.get(proc.pid)
+
+                # process_iter reuses Process objects and psutil caches their
+                # create_time() and exe(), so a recycled pid or an exec isn't
+                # visible on them; is_running() re-reads the creation time
+                if cached and cached[0] == create_time and proc.is_running():
+                    exe = cached[1]
+                else:
+                    fresh = psutil.Process(proc.pid)
+                    create_time = fresh.create_time()
+
+                    try:
+                        exe, cacheable = self._resolve_basename(fresh)
+                        exe = exe.lower()
+                    except psutil.AccessDenied:
+                        exe, cacheable = None, True
+
+                    if cacheable:
+                        self._pid_cache[proc.pid] = (create_time, exe)
+                    else:
+                        self._pid_cache.pop(proc.pid, None)
+
+                pids.add(proc.pid)
+
+                if exe is None:
+                    continue
 
-            await asyncio.sleep(1)
+                app = self.apps.get(exe)
+
+                if app:
+                    matches.append((create_time, proc, app))
+            except (psutil.AccessDenied, psutil.NoSuchProcess):
+                continue
+
+        for pid in self._pid_cache.keys() - pids:
+            del self._pid_cache[pid]
+
+        if matches:
+            start_time, proc, app = max(matches, key=itemgetter(0))
+            app.pid = proc.pid
+            app.start_time = start_time
+
+            if self.state.mode is not StateMode.RUNNING:
+                self.state.mode = StateMode.RUNNING
+                logger.info("New process is running: %s", app.title)
+                # queue the presence first so waiting plugins write after it
+                self._publish(self._presence(app))
+                self._set_process(app)
+            elif self.state.process is not app:
+                logger.info("Process updated to: %s", app.title)
+                self._publish(self._presence(app))
+                self._set_process(app)
+        elif self.state.mode is StateMode.RUNNING:
+            logger.info("Process stopped: %s", self.state.process.title)
+            self._set_process(None)
+            self.state.clear_server()
+            self.state.mode = StateMode.INACTIVE
+            self._publish(None)
 
     async def _watcher(self):
         while True:
-            for proc in self.process_iter():
-                try:
-                    exe = self.get_process_basename(proc)
-
-                    if exe == "wineserver" and not self.state.server:
-                        self.state.server = proc.exe()
-                        logging.debug(
-                            f"Using wineserver: {self.state.get_server_version()}"
-                        )
-                except (psutil.AccessDenied, psutil.NoSuchProcess):
-                    continue
+            if self.state.server and not psutil.pid_exists(self.state.server_pid):
+                self.state.clear_server()
+
+            if not self.state.server:
+                found = self.find_wineserver()
+
+                if found:
+                    self.state.server_pid, self.state.server = found
+                    version = await asyncio.get_running_loop().run_in_executor(
+                        None, self.state.get_server_version
+                    )
+                    logger.debug("Using wineserver: %s", version)
 
             if self.state.server:
-                if self.state.mode is not StateMode.SCANNING:
+                if self.state.mode is StateMode.INACTIVE:
                     self.state.mode = StateMode.SCANNING
-                    logging.debug(
+                    logger.debug(
                         "Watcher is in SCANNING state, scanning for running apps..."
                     )
 
-                await self._scan()
+                self._scan_once()
             else:
                 if self.state.mode is StateMode.RUNNING:
-                    async with self.lock:
-                        await self.rpc.clear()
+                    self._publish(None)
 
                 if self.state.mode is not StateMode.INACTIVE:
-                    self.state.process = None
+                    self._set_process(None)
                     self.state.mode = StateMode.INACTIVE
-                    self.state.server = None
-                    logging.debug("Watcher is in INACTIVE state.")
+                    self.state.clear_server()
+                    logger.debug("Watcher is in INACTIVE state.")
 
-            await asyncio.sleep(1)
+            await asyncio.sleep(self.poll_interval)
 
     async def _start(self):
-        logging.info("Connecting to Discord RPC Socket...")
+        logger.info("Connecting to Discord RPC Socket...")
         try:
             await self.rpc.connect()
         except ConnectionRefusedError:
-            logging.error("Couldn't connect to Discord RPC Socket.")
+            logger.error("Couldn't connect to Discord RPC Socket.")
             sys.exit(1)
-        logging.info("Starting watcher task...")
-        self.loop.create_task(self._watcher())
+        self._writer = self.loop.create_task(self._rpc_writer())
         for plugin in self.config["plugins"]:
             plug = self.load_plugin(plugin)
 
             if plug:
-                logging.info("Loading plugin: " + plugin)
+                logger.info("Loading plugin: %s", plugin)
                 task = self.loop.create_task(plug._plugin_entry(self))
                 on_exit = getattr(plug, "_plugin_exit", None)
 
                 if on_exit and callable(on_exit):
                     task.add_done_callback(on_exit)
             else:
-                logging.warning("Plugin Not Found: " + plugin)
+                logger.warning("Plugin Not Found: %s", plugin)
 
+        logger.info("Starting watcher...")
         await self._watcher()
 
     def start(self):